@@ -1,29 +1,36 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Body
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Body, Query
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import List, Dict, Optional
-import json
+from starlette.websockets import WebSocketState
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Dict, Optional, Set
+import orjson
 import os
-from datetime import datetime
+from datetime import datetime, timezone
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import asyncio
+import time
 import uvicorn
 import hashlib
+import hmac
 import uuid
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 import databases
 import sqlalchemy
-from sqlalchemy import Column, String, MetaData, Table, create_engine, select, desc, delete
+from sqlalchemy import Column, String, DateTime, Index, MetaData, Table, create_engine, select, desc, delete, func, text, tuple_
 
 # PostgreSQL Database URL
 from dotenv import load_dotenv
 import os
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
-# Create FastAPI app
-app = FastAPI(title="Wedding Invitation API")
 
-# Set up database
-database = databases.Database(DATABASE_URL)
+# Set up database with a warm, bounded asyncpg connection pool
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+database = databases.Database(DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
 metadata = MetaData()
 
 # Define wishes table
@@ -35,20 +42,68 @@ wishes = Table(
     Column("message", String),
     Column("password_hash", String),
     Column("date", String),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
 )
+Index("wishes_created_at_id_idx", wishes.c.created_at.desc(), wishes.c.id.desc())
+
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every worker's startup
+SCHEMA_LOCK_KEY = 727001
+
+
+def create_tables():
+    engine = create_engine(DATABASE_URL)
+    with engine.begin() as conn:
+        # Serialize schema changes between workers booting at the same time
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        metadata.create_all(conn)
+
+        # Upgrade tables created before created_at existed, backfilling it from
+        # the display date so old wishes keep their order
+        columns = {c["name"] for c in sqlalchemy.inspect(conn).get_columns("wishes")}
+        if "created_at" not in columns:
+            conn.execute(text("ALTER TABLE wishes ADD COLUMN created_at TIMESTAMP WITH TIME ZONE"))
+            conn.execute(text("UPDATE wishes SET created_at = COALESCE(to_timestamp(date, 'DD/MM/YYYY, HH24:MI'), now())"))
+            conn.execute(text("ALTER TABLE wishes ALTER COLUMN created_at SET DEFAULT now(), ALTER COLUMN created_at SET NOT NULL"))
+
+        # Keyset pages order by (created_at, id); replace the older
+        # created_at-only index with one matching that order
+        indexes = {i["name"] for i in sqlalchemy.inspect(conn).get_indexes("wishes")}
+        if "wishes_created_at_id_idx" not in indexes:
+            conn.execute(text("DROP INDEX IF EXISTS wishes_created_at_idx"))
+            conn.execute(text("CREATE INDEX wishes_created_at_id_idx ON wishes (created_at DESC, id DESC)"))
+
+        # Rows with a NULL date were left without created_at by an earlier
+        # backfill; this is an index lookup that normally matches nothing
+        conn.execute(text("UPDATE wishes SET created_at = now() WHERE created_at IS NULL"))
+    engine.dispose()
+
+
+# Startup and shutdown: create tables, then open and warm the pool
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(create_tables)
+    await database.connect()
+    await database.fetch_val("SELECT 1")
+    yield
+    await database.disconnect()
+
+
+# Create FastAPI app
+app = FastAPI(title="Wedding Invitation API", lifespan=lifespan)
 
-# Create tables
-engine = create_engine(DATABASE_URL)
-metadata.create_all(engine)
 
 # Models
+# Size limits reject oversized payloads before they reach the KDF or the database
 class WishBase(BaseModel):
-    name: str
-    message: str
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, str_max_length=2000)
+
+    name: str = Field(min_length=1, max_length=80)
+    message: str = Field(min_length=1, max_length=2000)
 
 
 class WishCreate(WishBase):
-    password: str
+    password: str = Field(min_length=4, max_length=128)
 
 
 class Wish(WishBase):
@@ -57,74 +112,252 @@ class Wish(WishBase):
 
 
 class WishDelete(BaseModel):
-    password: str
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
+    password: str = Field(min_length=1, max_length=128)
 
 
 # WebSocket connection manager
+BROADCAST_BATCH_SIZE = 50
+BROADCAST_SEND_TIMEOUT = 2
+WS_PING_INTERVAL = 20
+WS_PING_TIMEOUT = 10
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # Each socket maps to the task running its endpoint, so a client we
+        # give up on can be torn down even if a clean close isn't possible
+        self.active_connections: Dict[WebSocket, asyncio.Task] = {}
+        self.closing_tasks: Set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections[websocket] = asyncio.current_task()
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+
+    def drop(self, websocket: WebSocket):
+        # Close the socket so the browser reconnects (and refetches the list)
+        # instead of silently missing updates
+        endpoint_task = self.active_connections.pop(websocket, None)
+        if endpoint_task is None:
+            return
+        task = asyncio.create_task(self.close_dropped(websocket, endpoint_task))
+        self.closing_tasks.add(task)
+        task.add_done_callback(self.closing_tasks.discard)
+
+    async def close_dropped(self, websocket: WebSocket, endpoint_task: asyncio.Task):
+        if WebSocketState.DISCONNECTED in (websocket.client_state, websocket.application_state):
+            return
+        try:
+            await asyncio.wait_for(websocket.close(code=1011), BROADCAST_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            # The close frame can't get through either; tear down its endpoint
+            endpoint_task.cancel()
+        except Exception:
+            # Already closing or closed underneath us; its endpoint exits on its own
+            pass
 
     async def broadcast(self, message: Dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+        # Encode once for every client; compact, non-escaped UTF-8 text frame
+        payload = orjson.dumps(message).decode()
+        connections = list(self.active_connections)
+        # Clients that error or can't keep up (timeout) are dropped
+        failed = []
+        # Send in parallel batches, yielding between them so HTTP work isn't starved
+        for i in range(0, len(connections), BROADCAST_BATCH_SIZE):
+            batch = connections[i:i + BROADCAST_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(asyncio.wait_for(connection.send_text(payload), BROADCAST_SEND_TIMEOUT)
+                  for connection in batch),
+                return_exceptions=True,
+            )
+            failed.extend(c for c, r in zip(batch, results) if isinstance(r, Exception))
+            await asyncio.sleep(0)
+
+        for connection in failed:
+            self.drop(connection)
 
 
 manager = ConnectionManager()
 
+# Password hasher (Argon2id, salted, self-describing encoded hashes)
+ph = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=2)
+
+# Each Argon2 call needs 64 MiB, so cap how many run at once
+KDF_CONCURRENCY = int(os.getenv("KDF_CONCURRENCY", "2"))
+kdf_semaphore = asyncio.Semaphore(KDF_CONCURRENCY)
+
+# Recent successful verifies keyed by (stored hash, sha256 of the attempt),
+# so repeats skip the KDF; failed guesses are never kept
+VERIFY_CACHE_SIZE = 4096
+verify_cache: "OrderedDict[tuple, bool]" = OrderedDict()
+
 
 # Helper functions
+# (minute since epoch, formatted string) of the last formatted date
+last_formatted_minute = (None, "")
+
+
 def get_formatted_date():
-    now = datetime.now()
-    return now.strftime("%d/%m/%Y, %H:%M")
+    global last_formatted_minute
+    minute = int(time.time()) // 60
+    if minute != last_formatted_minute[0]:
+        formatted = datetime.fromtimestamp(minute * 60).strftime("%d/%m/%Y, %H:%M")
+        last_formatted_minute = (minute, formatted)
+    return last_formatted_minute[1]
 
 
 def hash_password(password):
-    # Simple password hashing
-    return hashlib.sha256(password.encode()).hexdigest()
+    return ph.hash(password)
+
+
+def is_legacy_hash(password_hash):
+    # Old rows store an unsalted SHA-256 hex digest
+    return len(password_hash) == 64 and all(c in "0123456789abcdef" for c in password_hash)
+
+
+def verify_password(password_hash, password):
+    if is_legacy_hash(password_hash):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
+    try:
+        return ph.verify(password_hash, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+
+async def run_kdf(func, *args):
+    async with kdf_semaphore:
+        return await asyncio.to_thread(func, *args)
+
+
+async def check_password(password_hash, password):
+    key = (password_hash, hashlib.sha256(password.encode()).hexdigest())
+    if key in verify_cache:
+        verify_cache.move_to_end(key)
+        return True
+
+    result = await run_kdf(verify_password, password_hash, password)
+    if result:
+        verify_cache[key] = True
+        if len(verify_cache) > VERIFY_CACHE_SIZE:
+            verify_cache.popitem(last=False)
+    return result
+
+
+def evict_password(password_hash):
+    for key in [k for k in verify_cache if k[0] == password_hash]:
+        del verify_cache[key]
 
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
-# Startup and shutdown events
-@app.on_event("startup")
-async def startup():
-    await database.connect()
+# Keyset pagination over (created_at, id), newest first
+WISHES_PAGE_SIZE = 50
+MAX_WISHES_PAGE_SIZE = 200
 
 
-@app.on_event("shutdown")
-async def shutdown():
-    await database.disconnect()
+def sanitize_wish(row) -> Dict:
+    # Return only necessary information (no passwords)
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "message": row["message"],
+        "date": row["date"],
+        "created_at": row["created_at"].isoformat()
+    }
+
+
+def wish_cursor(wish: Dict) -> str:
+    return f"{wish['created_at']}|{wish['id']}"
+
+
+def parse_cursor(cursor: str):
+    created_at, _, wish_id = cursor.partition("|")
+    try:
+        return datetime.fromisoformat(created_at), wish_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def fetch_wishes_page(limit: int, before=None) -> List[Dict]:
+    # Fetch one extra row so callers can tell whether another page exists
+    query = (
+        select(
+            wishes.c.id,
+            wishes.c.name,
+            wishes.c.message,
+            wishes.c.date,
+            wishes.c.created_at,
+        )
+        .order_by(desc(wishes.c.created_at), desc(wishes.c.id))
+        .limit(limit + 1)
+    )
+    if before is not None:
+        query = query.where(tuple_(wishes.c.created_at, wishes.c.id) < tuple_(*before))
+    result = await database.fetch_all(query)
+    return [sanitize_wish(row) for row in result]
+
+
+def wishes_page(rows: List[Dict], limit: int) -> Dict:
+    items = rows[:limit]
+    next_cursor = wish_cursor(items[-1]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+# In-memory copy of the first page (plus one look-ahead row); None until
+# loaded. Writes bump the version so a concurrent load started before the
+# write doesn't store a stale page. Only correct while the app runs as a
+# single worker (see the Procfile).
+wishes_cache: Optional[List[Dict]] = None
+wishes_cache_version = 0
+wishes_cache_lock = asyncio.Lock()
+
+
+def cache_add_wish():
+    global wishes_cache, wishes_cache_version
+    wishes_cache_version += 1
+    # Concurrent adds can finish out of created_at order, so prepending could
+    # misorder the page; reload it on the next read instead
+    wishes_cache = None
+
+
+def cache_remove_wish(wish_id: str):
+    global wishes_cache, wishes_cache_version
+    wishes_cache_version += 1
+    # The page would come up one row short, so reload it on the next read
+    if wishes_cache is not None and any(w["id"] == wish_id for w in wishes_cache):
+        wishes_cache = None
 
 
 # API Routes
 @app.get("/api/wishes")
-async def get_wishes():
+async def get_wishes(
+    limit: int = Query(WISHES_PAGE_SIZE, ge=1, le=MAX_WISHES_PAGE_SIZE),
+    before: Optional[str] = None,
+):
+    global wishes_cache
+    cursor = parse_cursor(before) if before else None
     try:
-        # Query all wishes and order by date (newest first)
-        query = wishes.select().order_by(desc(wishes.c.date))
-        result = await database.fetch_all(query)
-        
-        # Return only necessary information (no passwords)
-        sanitized_wishes = [
-            {
-                "id": row["id"],
-                "name": row["name"],
-                "message": row["message"],
-                "date": row["date"]
-            }
-            for row in result
-        ]
-        return sanitized_wishes
+        if cursor is not None or limit > WISHES_PAGE_SIZE:
+            return wishes_page(await fetch_wishes_page(limit, cursor), limit)
+
+        rows = wishes_cache
+        if rows is not None:
+            return wishes_page(rows, limit)
+
+        async with wishes_cache_lock:
+            rows = wishes_cache
+            if rows is None:
+                version = wishes_cache_version
+                rows = await fetch_wishes_page(WISHES_PAGE_SIZE)
+                if version == wishes_cache_version:
+                    wishes_cache = rows
+            return wishes_page(rows, limit)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
@@ -134,7 +367,7 @@ async def add_wish(wish: WishCreate):
     try:
         # Generate unique ID and hash password
         wish_id = str(uuid.uuid4())
-        hashed_password = hash_password(wish.password)
+        hashed_password = await run_kdf(hash_password, wish.password)
         
         # Create new wish
         new_wish = {
@@ -142,7 +375,8 @@ async def add_wish(wish: WishCreate):
             "name": wish.name,
             "password_hash": hashed_password,
             "message": wish.message,
-            "date": get_formatted_date()
+            "date": get_formatted_date(),
+            "created_at": datetime.now(timezone.utc)
         }
         
         # Insert into database
@@ -154,8 +388,10 @@ async def add_wish(wish: WishCreate):
             "id": new_wish["id"],
             "name": new_wish["name"],
             "message": new_wish["message"],
-            "date": new_wish["date"]
+            "date": new_wish["date"],
+            "created_at": new_wish["created_at"].isoformat()
         }
+        cache_add_wish()
         
         # Broadcast to all connected clients
         await manager.broadcast({
@@ -172,19 +408,21 @@ async def add_wish(wish: WishCreate):
 async def delete_wish(wish_id: str, wish_delete: WishDelete):
     try:
         # Find wish by ID
-        query = wishes.select().where(wishes.c.id == wish_id)
+        query = select(wishes.c.password_hash).where(wishes.c.id == wish_id)
         wish = await database.fetch_one(query)
         
         if not wish:
             raise HTTPException(status_code=404, detail="Wish not found")
         
         # Check password
-        if hash_password(wish_delete.password) != wish["password_hash"]:
+        if not await check_password(wish["password_hash"], wish_delete.password):
             raise HTTPException(status_code=401, detail="Invalid password")
         
         # Remove wish
         delete_query = wishes.delete().where(wishes.c.id == wish_id)
         await database.execute(delete_query)
+        evict_password(wish["password_hash"])
+        cache_remove_wish(wish_id)
         
         # Broadcast to all connected clients
         await manager.broadcast({
@@ -205,13 +443,13 @@ async def delete_wish(wish_id: str, wish_delete: WishDelete):
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
-        # Keep connection alive with ping/pong
+        # Liveness is handled by uvicorn's protocol-level pings; just drain
+        # incoming messages until the client goes away
         while True:
-            # Wait for a message (ping)
             await websocket.receive_text()
-            # Send pong response
-            await websocket.send_json({"action": "pong"})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
@@ -222,4 +460,14 @@ def serve_html(full_path: str):
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Wishes cache and websocket clients are per process, so stay on one
+    # worker (here and in the Procfile) until there is a shared pub/sub
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=1,
+        reload=os.getenv("RELOAD") == "1",
+        ws_ping_interval=WS_PING_INTERVAL,
+        ws_ping_timeout=WS_PING_TIMEOUT,
+    )